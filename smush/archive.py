@@ -0,0 +1,114 @@
+import os, os.path, shutil, tempfile, tarfile, zipfile, mimetypes
+
+class Archive(object):
+    """
+    Streams the members of a tar or zip archive through a callback, writing a new archive with
+    the (possibly optimised) image members and every other member passed through unchanged.
+
+    Only one image member at a time is staged on disk.
+    """
+
+    extensions = ('.tar', '.tar.gz', '.tgz', '.zip')
+
+
+    def __init__(self, path):
+        self.path = path
+
+
+    @staticmethod
+    def is_archive(path):
+        """
+        Returns whether path looks like an archive smush can stream
+        """
+        return path.lower().endswith(Archive.extensions) and os.path.isfile(path)
+
+
+    def _is_image(self, name):
+        (type, encoding) = mimetypes.guess_type(name)
+        return type is not None and type.startswith('image') and encoding is None
+
+
+    def rewrite(self, output, callback):
+        """
+        Calls callback(staged_path, member_name) for each image member, and writes the result to
+        output. If output is None the members are only handed to callback.
+        """
+        staging_dir = tempfile.mkdtemp(prefix='smush-')
+        try:
+            if self.path.lower().endswith('.zip'):
+                self.__rewrite_zip(output, callback, staging_dir)
+            else:
+                self.__rewrite_tar(output, callback, staging_dir)
+        finally:
+            shutil.rmtree(staging_dir, True)
+
+
+    def __stage(self, source, name, staging_dir):
+        staged = os.path.join(staging_dir, os.path.basename(name))
+        destination = open(staged, 'wb')
+        try:
+            shutil.copyfileobj(source, destination)
+        finally:
+            destination.close()
+        return staged
+
+
+    def __rewrite_tar(self, output, callback, staging_dir):
+        # stream mode reads the members strictly in order, so the input is never seeked
+        tar = tarfile.open(self.path, 'r|*')
+        out = None
+        if output is not None:
+            compressed = self.path.lower().endswith(('.tar.gz', '.tgz'))
+            out = tarfile.open(output, compressed and 'w|gz' or 'w|')
+
+        try:
+            for member in tar:
+                if member.isfile() and self._is_image(member.name):
+                    staged = self.__stage(tar.extractfile(member), member.name, staging_dir)
+                    callback(staged, member.name)
+                    if out is not None:
+                        member.size = os.path.getsize(staged)
+                        data = open(staged, 'rb')
+                        try:
+                            out.addfile(member, data)
+                        finally:
+                            data.close()
+                    os.unlink(staged)
+                elif out is not None:
+                    out.addfile(member, member.isfile() and tar.extractfile(member) or None)
+        finally:
+            if out is not None:
+                out.close()
+            tar.close()
+
+
+    def __rewrite_zip(self, output, callback, staging_dir):
+        archive = zipfile.ZipFile(self.path)
+        out = None
+        if output is not None:
+            out = zipfile.ZipFile(output, 'w', allowZip64=True)
+
+        try:
+            for info in archive.infolist():
+                if not info.filename.endswith('/') and self._is_image(info.filename):
+                    member = archive.open(info)
+                    try:
+                        staged = self.__stage(member, info.filename, staging_dir)
+                    finally:
+                        member.close()
+                    callback(staged, info.filename)
+                    if out is not None:
+                        data = open(staged, 'rb')
+                        try:
+                            out.writestr(info, data.read())
+                        finally:
+                            data.close()
+                    os.unlink(staged)
+                elif out is not None:
+                    # zipfile can only write whole members, so these pass through memory one
+                    # at a time
+                    out.writestr(info, archive.read(info))
+        finally:
+            if out is not None:
+                out.close()
+            archive.close()
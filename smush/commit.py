@@ -0,0 +1,139 @@
+import os, os.path, stat, errno, shutil, tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request number for cloning a file's extents on Linux (btrfs, xfs and friends)
+FICLONE = 0x40049409
+
+
+def stage_path(path, suffix='', directory=None):
+    """
+    Returns the name of a new, empty hidden file in the same directory as path, so that it can
+    later be renamed over path atomically, or in directory if one is given
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.realpath(path))
+    (fd, staged) = tempfile.mkstemp(dir=directory, prefix='.smush-', suffix=suffix)
+    os.close(fd)
+    return staged
+
+
+def clone_file(src, dst):
+    """
+    Copies src to dst, sharing the data blocks (reflink) where the filesystem supports it, and
+    falling back to an ordinary copy otherwise
+    """
+    source = open(src, 'rb')
+    try:
+        destination = open(dst, 'wb')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+                    return
+                except (IOError, OSError):
+                    pass
+
+            shutil.copyfileobj(source, destination)
+        finally:
+            destination.close()
+    finally:
+        source.close()
+
+
+def sync_file(path):
+    """
+    Flushes the data and metadata of path to disk, so that renaming it over another file can't
+    leave an empty or partial file behind after a crash
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_dir(directory):
+    """
+    Flushes a directory to disk, making a rename into it durable. Not every platform can open a
+    directory, in which case nothing is done.
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def move_file(src, dst, sync=True):
+    """
+    Moves src to dst, replacing dst atomically. A plain rename is used where src and dst share a
+    filesystem, otherwise the data is cloned into a staged file next to dst first.
+
+    The data is flushed to disk before the rename unless sync is False, e.g. for intermediate
+    files that don't have to survive a crash.
+    """
+    try:
+        if sync:
+            sync_file(src)
+        os.rename(src, dst)
+        if sync:
+            sync_dir(os.path.dirname(os.path.abspath(dst)))
+        return
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    staged = stage_path(dst)
+    try:
+        clone_file(src, staged)
+        if sync:
+            sync_file(staged)
+        os.rename(staged, dst)
+        if sync:
+            sync_dir(os.path.dirname(staged))
+    except:
+        if os.path.isfile(staged):
+            os.unlink(staged)
+        raise
+    os.unlink(src)
+
+
+def copy_metadata(src, dst, preserve_mtime=False, preserve_owner=False):
+    """
+    Copies the permission bits, and optionally the owner and access/modification times, of src
+    to dst
+    """
+    st = os.stat(src)
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    if preserve_owner:
+        try:
+            os.chown(dst, st.st_uid, st.st_gid)
+        except OSError:
+            # only root may give files away; keep the group at least if we can
+            try:
+                os.chown(dst, -1, st.st_gid)
+            except OSError:
+                pass
+    if preserve_mtime:
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+
+def replace_file(staged, target, preserve_mtime=False):
+    """
+    Atomically and durably replaces target with staged, which must be on the same filesystem,
+    keeping the mode and ownership of target
+    """
+    target = os.path.realpath(target)
+    copy_metadata(target, staged, preserve_mtime, preserve_owner=True)
+    sync_file(staged)
+    os.rename(staged, target)
+    sync_dir(os.path.dirname(target))
@@ -0,0 +1,153 @@
+import os, os.path, time, tempfile, logging
+
+class Metrics(object):
+    """
+    Counters and histograms kept across a smush session, written out in the Prometheus textfile
+    format so node_exporter's textfile collector can pick them up.
+
+    When no path is given the values are still collected but never written.
+    """
+
+    # upper bounds (in seconds) of the tool duration histogram buckets
+    duration_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    # seconds between writes while running
+    default_interval = 60
+
+    descriptions = {
+        'smush_files_scanned_total': ('counter', 'Files handed to an optimiser, by image format.'),
+        'smush_files_unchanged_total': ('counter', 'Files skipped because they had not changed since the last run, by image format.'),
+        'smush_files_optimised_total': ('counter', 'Files for which a smaller version was found, by image format.'),
+        'smush_bytes_in_total': ('counter', 'Size of files before optimisation, by image format.'),
+        'smush_bytes_out_total': ('counter', 'Size of files after optimisation, by image format.'),
+        'smush_sidecars_total': ('counter', 'WebP sidecars that beat the optimised image, by source format.'),
+        'smush_sidecar_bytes_saved_total': ('counter', 'Bytes saved by WebP sidecars over the optimised images, by source format.'),
+        'smush_router_decisions_total': ('counter', 'Files sent down the full or light path, or skipped, by image format and route.'),
+        'smush_identify_failures_total': ('counter', 'Files that identify could not recognise.'),
+        'smush_tool_invocations_total': ('counter', 'External tool invocations, by tool.'),
+        'smush_tool_failures_total': ('counter', 'External tool invocations that exited non-zero, by tool.'),
+        'smush_tool_duration_seconds': ('histogram', 'Wall time of external tool invocations, by tool.'),
+        'smush_last_write_timestamp_seconds': ('gauge', 'Unix time the metrics were last written.'),
+    }
+
+
+    def __init__(self, path=None, interval=None):
+        self.path = path
+        # 0 writes after every file
+        self.interval = interval
+        if interval is None:
+            self.interval = Metrics.default_interval
+        self.counters = {}
+        self.histograms = {}
+        self.last_write = time.time()
+        # objects with a tool_call method that want to see every invocation, e.g. the profiler
+        self.listeners = []
+
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds value to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value in a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = {'buckets': [0] * len(Metrics.duration_buckets), 'sum': 0.0, 'count': 0}
+        histogram = self.histograms[key]
+        for i, bound in enumerate(Metrics.duration_buckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+    def tool_call(self, args, seconds, retcode, input=None):
+        """
+        Records a single invocation of an external tool on input
+        """
+        tool = os.path.basename(args[0])
+        self.inc('smush_tool_invocations_total', tool=tool)
+        self.observe('smush_tool_duration_seconds', seconds, tool=tool)
+        if retcode != 0:
+            self.inc('smush_tool_failures_total', tool=tool)
+        for listener in self.listeners:
+            listener.tool_call(args, seconds, retcode, input)
+
+
+    def maybe_write(self):
+        """
+        Writes the metrics if the configured interval has passed since the last write
+        """
+        if self.path and time.time() - self.last_write >= self.interval:
+            self.write()
+
+
+    def write(self):
+        """
+        Atomically replaces the metrics file, so a scrape never sees a partially written file
+        """
+        if not self.path:
+            return
+
+        self.last_write = time.time()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        (fd, temp_path) = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(self.path))
+        try:
+            temp = os.fdopen(fd, 'w')
+            try:
+                temp.write(self.render())
+            finally:
+                temp.close()
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError), e:
+            logging.error('Unable to write metrics to %s: %s' % (self.path, e))
+            if os.path.isfile(temp_path):
+                os.unlink(temp_path)
+
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        # name -> list of (labels, lines), so each label set can be sorted as a whole and the
+        # histogram buckets stay in increasing order
+        samples = {}
+        for (name, labels), value in self.counters.iteritems():
+            samples.setdefault(name, []).append((labels, ['%s%s %s' % (name, self.__format_labels(labels), value)]))
+
+        for (name, labels), histogram in self.histograms.iteritems():
+            lines = []
+            samples.setdefault(name, []).append((labels, lines))
+            for bound, count in zip(Metrics.duration_buckets, histogram['buckets']):
+                lines.append('%s_bucket%s %d' % (name, self.__format_labels(labels + (('le', repr(float(bound))),)), count))
+            lines.append('%s_bucket%s %d' % (name, self.__format_labels(labels + (('le', '+Inf'),)), histogram['count']))
+            lines.append('%s_sum%s %f' % (name, self.__format_labels(labels), histogram['sum']))
+            lines.append('%s_count%s %d' % (name, self.__format_labels(labels), histogram['count']))
+
+        samples['smush_last_write_timestamp_seconds'] = [((), ['smush_last_write_timestamp_seconds %f' % self.last_write])]
+
+        output = []
+        for name in sorted(samples):
+            (type, description) = Metrics.descriptions.get(name, ('untyped', name))
+            output.append('# HELP %s %s' % (name, description))
+            output.append('# TYPE %s %s' % (name, type))
+            for (labels, lines) in sorted(samples[name]):
+                output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+
+    def __format_labels(self, labels):
+        if not labels:
+            return ''
+        pairs = []
+        for name, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append('%s="%s"' % (name, value))
+        return '{%s}' % ','.join(pairs)
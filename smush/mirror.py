@@ -0,0 +1,167 @@
+import os, os.path, json, logging
+import commit
+
+class Mirror(object):
+    """
+    The --save-optimized directory, kept between runs.
+
+    A manifest in the mirror root remembers, for each source image, its size and mtime when it
+    was last optimised, the command set that was used and the results that were reported, so
+    unchanged images can be skipped on the next run.
+    """
+
+    manifest_name = '.smush-manifest.json'
+
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.manifest_path = os.path.join(self.path, Mirror.manifest_name)
+        self.entries = {}
+
+        if os.path.isfile(self.manifest_path):
+            try:
+                self.entries = json.load(open(self.manifest_path))
+            except ValueError:
+                logging.warning('Ignoring unreadable manifest %s' % (self.manifest_path))
+
+
+    def _relpath(self, input, original_dir):
+        if os.path.isfile(original_dir):
+            original_dir = os.path.dirname(original_dir)
+        return os.path.relpath(input, original_dir)
+
+
+    def path_for(self, input, original_dir):
+        """
+        Returns where the optimised version of input is saved in the mirror
+        """
+        return os.path.join(self.path, self._relpath(input, original_dir))
+
+
+    def lookup(self, input, original_dir):
+        """
+        Returns the manifest entry for input if input hasn't changed since it was recorded, and
+        its mirrored copy (if one was saved) is still there and newer than input
+        """
+        entry = self.entries.get(self._relpath(input, original_dir))
+        if entry is None or entry['source'] != os.path.abspath(input):
+            return None
+
+        st = os.stat(input)
+        if entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            return None
+
+        optimized_path = self.path_for(input, original_dir)
+        if entry['saved']:
+            if not os.path.isfile(optimized_path) or os.path.getmtime(optimized_path) < st.st_mtime:
+                return None
+
+        if entry.get('sidecar') and not os.path.isfile(optimized_path + '.webp'):
+            return None
+
+        return entry
+
+
+    def staging_dir(self):
+        """
+        Returns a directory on the mirror's filesystem for building files that will be saved to
+        it, creating the mirror if necessary
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        return self.path
+
+
+    def save(self, staged, input, original_dir, preserve_mtime=False):
+        """
+        Moves the optimised version of input into the mirror
+        """
+        optimized_path = self.path_for(input, original_dir)
+        optimized_dir = os.path.dirname(optimized_path)
+
+        if not os.path.exists(optimized_dir):
+            os.makedirs(optimized_dir)
+
+        logging.info('Saving optimised image to %s' % (optimized_path))
+        commit.move_file(staged, optimized_path)
+        commit.copy_metadata(input, optimized_path, preserve_mtime)
+
+
+    def record(self, input, original_dir, format, commands, results, saved):
+        """
+        Remembers how input was optimised. An earlier mirrored copy is removed if nothing was
+        saved this time, and an earlier sidecar always is; record_sidecar() is called afterwards
+        if a new one was generated.
+        """
+        relpath = self._relpath(input, original_dir)
+        if not saved:
+            self.__remove(relpath)
+        else:
+            sidecar_path = self.path_for(input, original_dir) + '.webp'
+            if os.path.isfile(sidecar_path):
+                os.unlink(sidecar_path)
+
+        st = os.stat(input)
+        self.entries[relpath] = {
+            'source': os.path.abspath(input),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'format': format,
+            'commands': commands,
+            'results': results,
+            'saved': saved,
+        }
+
+
+    def record_sidecar(self, input, original_dir, commands, result):
+        """
+        Remembers the WebP sidecar generated for input, if any
+        """
+        entry = self.entries.get(self._relpath(input, original_dir))
+        if entry is not None:
+            entry['webp'] = commands
+            entry['sidecar'] = result
+
+
+    def prune(self):
+        """
+        Removes mirrored copies, and manifest entries, whose source images no longer exist
+        """
+        for relpath in self.entries.keys():
+            if not os.path.exists(self.entries[relpath]['source']):
+                logging.info('Pruning %s from %s' % (relpath, self.path))
+                self.__remove(relpath)
+                del self.entries[relpath]
+
+
+    def write(self):
+        """
+        Atomically replaces the manifest
+        """
+        staged = commit.stage_path(self.manifest_path, '', self.staging_dir())
+        try:
+            manifest = open(staged, 'w')
+            try:
+                json.dump(self.entries, manifest, indent=1, sort_keys=True)
+            finally:
+                manifest.close()
+            os.chmod(staged, 0644)
+            os.rename(staged, self.manifest_path)
+        except:
+            if os.path.isfile(staged):
+                os.unlink(staged)
+            raise
+
+
+    def __remove(self, relpath):
+        optimized_path = os.path.join(self.path, relpath)
+        for path in (optimized_path, optimized_path + '.webp'):
+            if os.path.isfile(path):
+                os.unlink(path)
+
+        # tidy up directories left empty, but never the mirror root itself
+        directory = os.path.dirname(optimized_path)
+        while directory != self.path and directory.startswith(self.path) and os.path.isdir(directory) \
+                and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
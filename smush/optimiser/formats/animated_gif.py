@@ -11,5 +11,8 @@ class OptimiseAnimatedGIF(Optimiser):
         # the command to execute this optimiser
         self.commands = ('gifsicle -O2 "__INPUT__" --output "__OUTPUT__"',)
 
+        # the command for small files
+        self.light_commands = self.commands
+
         # format as returned by 'identify'
         self.format = "GIFGIF"
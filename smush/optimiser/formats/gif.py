@@ -1,5 +1,6 @@
 import os.path
 import shutil
+import hashlib
 from optimiser.optimiser import Optimiser
 from animated_gif import OptimiseAnimatedGIF
 import logging
@@ -12,6 +13,8 @@ class OptimiseGIF(Optimiser):
     Animated gifs get optimised according to the commands in OptimiseAnimatedGIF
     """
 
+    quiet_flags = ('-q',)
+
 
     def __init__(self, **kwargs):
         super(OptimiseGIF, self).__init__(**kwargs)
@@ -26,7 +29,10 @@ class OptimiseGIF(Optimiser):
             pngcrush)
 
         # variable so we can easily determine whether a gif is animated or not
-        self.animated_gif_optimiser = OptimiseAnimatedGIF()
+        self.animated_gif_optimiser = OptimiseAnimatedGIF(metrics=self.metrics, min_percent=self.min_percent)
+
+        # small gifs are optimised with gifsicle rather than converted to png
+        self.light_commands = self.animated_gif_optimiser.commands
 
         self.converted_to_png = False
         self.is_animated = False
@@ -35,8 +41,15 @@ class OptimiseGIF(Optimiser):
         self.format = "GIF"
 
 
-    def set_input(self, input):
-        super(OptimiseGIF, self).set_input(input)
+    def fingerprint(self):
+        """
+        Includes the animated gif commands, since either set may be applied
+        """
+        return hashlib.sha1(super(OptimiseGIF, self).fingerprint() + self.animated_gif_optimiser.fingerprint()).hexdigest()
+
+
+    def set_input(self, input, light=False):
+        super(OptimiseGIF, self).set_input(input, light)
         self.converted_to_png = False
         self.is_animated = False
 
@@ -51,6 +64,8 @@ class OptimiseGIF(Optimiser):
         """
         Returns the next command to apply
         """
+        if self.light:
+            return super(OptimiseGIF, self)._get_command()
 
         command = False
 
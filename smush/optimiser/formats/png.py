@@ -7,6 +7,11 @@ class OptimisePNG(Optimiser):
     (http://pmt.sourceforge.net/pngcrush/) to crush them.
     """
 
+    # advpng and pngcrush work on the previous output in place
+    reuses_output = True
+
+    quiet_flags = ('-quiet', '-q')
+
 
     def __init__(self, **kwargs):
         super(OptimisePNG, self).__init__(**kwargs)
@@ -14,11 +19,13 @@ class OptimisePNG(Optimiser):
         if kwargs.get('quiet') == True:
             # pngcrush = 'pngcrush -rem alla -brute -reduce -q "__INPUT__" "__OUTPUT__"'
             optipng =  u"optipng -quiet -force -o7 '__INPUT__' -out '__OUTPUT__'"
+            optipng_light =  u"optipng -quiet -force -o1 -strip all '__INPUT__' -out '__OUTPUT__'"
             advpng  =  u"advpng -z4 '__OUTPUT__'"
             pngcrush =  u"pngcrush -q -rem gAMA -rem alla -rem cHRM -rem iCCP -rem sRGB -rem time -ext '__OUTPUT__'"
         else:
             # pngcrush = 'pngcrush -rem alla -brute -reduce "__INPUT__" "__OUTPUT__"'
             optipng =  u"optipng -force -o7 '__INPUT__' -out '__OUTPUT__'"
+            optipng_light =  u"optipng -force -o1 -strip all '__INPUT__' -out '__OUTPUT__'"
             advpng  =  u"advpng -z4 '__OUTPUT__'"
             pngcrush =  u"pngcrush -rem gAMA -rem alla -rem cHRM -rem iCCP -rem sRGB -rem time -ext '__OUTPUT__'"
         rm =  u"rm '__OUTPUT__'"
@@ -27,6 +34,9 @@ class OptimisePNG(Optimiser):
         #self.commands = ('pngnq -n 256 -o "__OUTPUT__" "__INPUT__"', pngcrush)
         self.commands = (optipng,advpng,pngcrush,)
 
+        # the command for small files
+        self.light_commands = (optipng_light,)
+
         # format as returned by 'identify'
         self.format = "PNG"
 
@@ -38,6 +48,12 @@ class OptimisePNG(Optimiser):
        (basename, extension) = os.path.splitext(self.input)
 
        if extension.lower() == '.png':
-           return basename + Optimiser.output_suffix
+           output_file_name = basename + Optimiser.output_suffix
+       else:
+           output_file_name = self.input + Optimiser.output_suffix
+
+       if self.list_only == False:
+           return output_file_name
 
-       return self.input + Optimiser.output_suffix
\ No newline at end of file
+       # the same name for every command, since advpng and pngcrush work on it in place
+       return os.path.join(self._staging_dir(), '.smush-%d-%s' % (os.getpid(), os.path.basename(output_file_name)))
\ No newline at end of file
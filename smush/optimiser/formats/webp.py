@@ -0,0 +1,164 @@
+import os.path
+import hashlib
+import shlex
+import logging
+from optimiser.optimiser import Optimiser
+import commit
+
+class OptimiseWebP(Optimiser):
+    """
+    Generates .webp sidecars with cwebp and gif2webp (https://developers.google.com/speed/webp/).
+    PNGs and GIFs are encoded losslessly, JPEGs at the quality they were saved with.
+
+    A sidecar is only kept if it's smaller than the optimised image by at least 'webp_margin'
+    percent.
+    """
+
+    sidecar_suffix = ".webp"
+    quality_placeholder = "__QUALITY__"
+
+    # minimum percent a sidecar must save over the optimised image
+    default_margin = 5
+
+
+    def __init__(self, **kwargs):
+        super(OptimiseWebP, self).__init__(**kwargs)
+
+        self.margin = kwargs.get('webp_margin')
+        if self.margin is None:
+            self.margin = OptimiseWebP.default_margin
+
+        # the command to execute for each source format, chosen by sniffing the file itself since
+        # a non-animated gif may have been converted to a png by now
+        self.commands = {
+            'PNG': 'cwebp -quiet -lossless -m 6 -q 100 "__INPUT__" -o "__OUTPUT__"',
+            'GIF': 'gif2webp -quiet -m 6 "__INPUT__" -o "__OUTPUT__"',
+            'JPEG': 'cwebp -quiet -m 6 -q __QUALITY__ "__INPUT__" -o "__OUTPUT__"',
+        }
+
+        self.sidecars = 0
+        self.sidecar_bytes_saved = 0
+        self.array_sidecar_file = []
+
+        # format as returned by 'identify'
+        self.format = "WEBP"
+
+
+    def fingerprint(self):
+        """
+        Returns a digest of the commands and the margin
+        """
+        commands = [self.commands[key] for key in sorted(self.commands)]
+        return hashlib.sha1('\n'.join(commands + [str(self.margin)])).hexdigest()
+
+
+    def restore_sidecar(self, result):
+        """
+        Counts a sidecar written on an earlier run for an unchanged image
+        """
+        self.sidecars += 1
+        self.sidecar_bytes_saved += result['bytes_saved']
+        self.array_sidecar_file.append(result)
+
+
+    def _sniff_format(self, input):
+        """
+        Returns the format of an image from its first bytes
+        """
+        image = open(input, 'rb')
+        try:
+            magic = image.read(8)
+        finally:
+            image.close()
+
+        if magic.startswith('\x89PNG'):
+            return 'PNG'
+        if magic.startswith('GIF8'):
+            return 'GIF'
+        if magic.startswith('\xff\xd8'):
+            return 'JPEG'
+        return None
+
+
+    def _get_jpeg_quality(self, input):
+        """
+        Returns the quality a jpeg was saved with, as estimated by ImageMagick
+        """
+        args = ['identify', '-format', '%Q', input]
+        try:
+            if self._call(args, input) == 0:
+                quality = self.stdout.read().strip()
+                if quality.isdigit():
+                    return quality
+        except OSError:
+            logging.error("Error executing command %s. Error was %s" % (' '.join(args), OSError))
+        return '90'
+
+
+    def sidecar(self, input, reference_size, destination):
+        """
+        Encodes input as WebP and moves the result to destination if it beats reference_size (the
+        size of the optimised image) by the margin. A stale sidecar at destination is removed
+        otherwise. Returns the result record, or None if no sidecar was written.
+        """
+        self.set_input(input)
+        format = self._sniff_format(input)
+        result = None
+
+        if format is not None:
+            command = self.commands[format]
+            if format == 'JPEG':
+                command = command.replace(OptimiseWebP.quality_placeholder, self._get_jpeg_quality(input))
+
+            output_file_name = self._get_output_file_name()
+            command = command.replace(Optimiser.input_placeholder, input).replace(Optimiser.output_placeholder, output_file_name)
+            logging.info("Executing %s" % (command))
+
+            try:
+                retcode = self._call(shlex.split(command), input)
+            except OSError:
+                logging.error("Error executing command %s. Error was %s" % (command, OSError))
+                retcode = -1
+
+            try:
+                if retcode == 0 and os.path.isfile(output_file_name):
+                    result = self.__keep_if_smaller(input, output_file_name, format, reference_size, destination)
+            finally:
+                if os.path.isfile(output_file_name):
+                    os.unlink(output_file_name)
+
+        if result is None and destination and os.path.isfile(destination):
+            logging.info("Removing stale sidecar %s" % (destination))
+            os.unlink(destination)
+
+        return result
+
+
+    def __keep_if_smaller(self, input, output, format, reference_size, destination):
+        output_size = os.path.getsize(output)
+        if output_size == 0 or output_size > reference_size * (100 - self.margin) / 100.0:
+            return None
+
+        bytes_saved = reference_size - output_size
+        result = {
+            'name': input + OptimiseWebP.sidecar_suffix,
+            'input_size': reference_size,
+            'output_size': output_size,
+            'bytes_saved': bytes_saved,
+            'bytes_saved_percent': int(100 - round((output_size / float(reference_size)) * 100)),
+        }
+
+        if destination:
+            destination_dir = os.path.dirname(destination)
+            if not os.path.exists(destination_dir):
+                os.makedirs(destination_dir)
+            logging.info("Saving WebP sidecar to %s" % (destination))
+            commit.move_file(output, destination)
+            commit.copy_metadata(input, destination, self.preserve_mtime)
+
+        self.sidecars += 1
+        self.sidecar_bytes_saved += bytes_saved
+        self.array_sidecar_file.append(result)
+        self.metrics.inc('smush_sidecars_total', format=format)
+        self.metrics.inc('smush_sidecar_bytes_saved_total', bytes_saved, format=format)
+        return result
@@ -6,7 +6,11 @@ import sys
 import shutil
 import logging
 import tempfile
+import time
+import hashlib
 from scratch import Scratch
+from metrics import Metrics
+import commit
 
 class Optimiser(object):
     """
@@ -19,18 +23,34 @@ class Optimiser(object):
     # string to place between the basename and extension of output images
     output_suffix = "-opt.smush"
 
+    # whether later commands modify the previous output file in place, in which case an accepted
+    # output has to be copied rather than moved out of the way
+    reuses_output = False
+
+    # options that only make a tool less chatty, left out of fingerprints so running with and
+    # without --quiet shares cached results
+    quiet_flags = ()
+
+    # the cheaper commands applied to small files, for formats that have any
+    light_commands = ()
+
 
     def __init__(self, **kwargs):
         # the number of times the _get_command iterator has been run
         self.iterations = 0
+        # whether the cheap light_commands are applied instead of commands
+        self.light = False
         self.files_scanned = 0
         self.files_optimised = 0
         self.bytes_saved = 0
         self.list_only = kwargs.get('list_only')
         self.min_percent = kwargs.get('min_percent')
-        self.save_optimized = kwargs.get('save_optimized')
+        self.mirror = kwargs.get('mirror')
+        self.router = kwargs.get('router')
+        self.preserve_mtime = kwargs.get('preserve_mtime')
         self.array_optimised_file = []
         self.quiet = kwargs.get('quiet')
+        self.metrics = kwargs.get('metrics') or Metrics()
         self.stdout = Scratch()
         self.stderr = Scratch()
 
@@ -38,9 +58,35 @@ class Optimiser(object):
         self.stdout.destruct()
         self.stderr.destruct()
 
-    def set_input(self, input):
+    def set_input(self, input, light=False):
         self.iterations = 0
         self.input = input
+        self.light = light
+
+
+    def fingerprint(self):
+        """
+        Returns a digest of everything that decides what this optimiser produces, used to tell
+        whether a cached result is still valid
+        """
+        commands = self.commands
+        if self.router is not None:
+            commands = commands + self.light_commands
+        commands = tuple([' '.join([arg for arg in command.split() if arg not in self.quiet_flags]) for command in commands])
+        if self.router is not None:
+            commands = commands + (self.router.describe(self.format),)
+        return hashlib.sha1('\n'.join(commands + (str(self.min_percent),))).hexdigest()
+
+
+    def restore(self, entry):
+        """
+        Counts a file that was skipped because it hasn't changed since it was last optimised,
+        reporting the results recorded at the time
+        """
+        self.files_scanned += 1
+        self.array_optimised_file.extend(entry['results'])
+        self.metrics.inc('smush_files_scanned_total', format=self.format)
+        self.metrics.inc('smush_files_unchanged_total', format=self.format)
 
 
     def _get_command(self):
@@ -48,19 +94,36 @@ class Optimiser(object):
         Returns the next command to apply
         """
         command = False
+        commands = self.commands
+        if self.light:
+            commands = self.light_commands
         
-        if self.iterations < len(self.commands):
-            command = self.commands[self.iterations]
+        if self.iterations < len(commands):
+            command = commands[self.iterations]
             self.iterations += 1
 
         return command
 
 
+    def _staging_dir(self):
+        """
+        Returns the directory for outputs and staged files. When the input is going to be
+        replaced that's the input's own directory, and when the result is saved to the mirror
+        it's the mirror, so the final rename stays on one filesystem; in list-only mode the
+        input's directory may not even be writable.
+        """
+        if self.list_only == False:
+            return os.path.dirname(os.path.realpath(self.input))
+        if self.mirror is not None:
+            return self.mirror.staging_dir()
+        return tempfile.gettempdir()
+
+
     def _get_output_file_name(self):
         """
         Returns the input file name with Optimiser.output_suffix inserted before the extension
         """
-        temp = tempfile.mkstemp(suffix=Optimiser.output_suffix)
+        temp = tempfile.mkstemp(suffix=Optimiser.output_suffix, prefix='.smush-', dir=self._staging_dir())
         try:
             output_file_name = temp[1]
             os.unlink(output_file_name)
@@ -76,6 +139,16 @@ class Optimiser(object):
         return command.replace(Optimiser.input_placeholder, input).replace(Optimiser.output_placeholder, output)
 
 
+    def _call(self, args, input):
+        """
+        Runs an external tool on input, recording its duration and exit code in the metrics
+        """
+        started = time.time()
+        retcode = subprocess.call(args, stdout=self.stdout.opened, stderr=self.stderr.opened)
+        self.metrics.tool_call(args, time.time() - started, retcode, input)
+        return retcode
+
+
     def _is_acceptable_image(self, input):
         """
         Returns whether the input image can be used by a particular optimiser.
@@ -87,7 +160,7 @@ class Optimiser(object):
         args = shlex.split(test_command)
 
         try:
-            retcode = subprocess.call(args, stdout=self.stdout.opened, stderr=self.stderr.opened)
+            retcode = self._call(args, input)
         except OSError:
             logging.error("Error executing command %s. Error was %s" % (test_command, OSError))
             sys.exit(1)
@@ -95,8 +168,10 @@ class Optimiser(object):
             # most likely no file matched
             if self.quiet == False:
                 logging.warning("Cannot identify file.")
+            self.metrics.inc('smush_identify_failures_total')
             return False
         if retcode != 0:
+            self.metrics.inc('smush_identify_failures_total')
             if self.quiet == False:
                 logging.warning("Cannot identify file.")
             return False
@@ -108,25 +183,49 @@ class Optimiser(object):
         """
         Calls the 'optimise_image' method on the object. Tests the 'optimised' file size. If the
         generated file is larger than the original file, discard it, otherwise discard the input file.
+
+        Returns False if the input was rejected by this optimiser.
         """
         # make sure the input image is acceptable for this optimiser
         if not self._is_acceptable_image(self.input):
             logging.warning("%s is not a valid image for this optimiser" % (self.input))
-            return
+            return False
 
         self.files_scanned += 1
+        self.metrics.inc('smush_files_scanned_total', format=self.format)
+        input_size = os.path.getsize(self.input)
+        self.output_size = input_size
+        # the smallest version found so far; the input itself is only replaced once at the end
+        self._best = self.input
+
+        try:
+            self.__run_commands(original_dir)
+        finally:
+            if self._best != self.input and os.path.isfile(self._best):
+                os.unlink(self._best)
+
+        self.metrics.inc('smush_bytes_in_total', input_size, format=self.format)
+        self.metrics.inc('smush_bytes_out_total', self.output_size, format=self.format)
+        if self.output_size < input_size:
+            self.metrics.inc('smush_files_optimised_total', format=self.format)
+        return True
+
 
+    def __run_commands(self, original_dir):
+        """
+        Applies each command in turn, then commits the smallest result
+        """
         while True:
             command = self._get_command()
             output_file_name = self._get_output_file_name()
 
             if command:
-                command = self.__replace_placeholders(command, self.input, output_file_name)
+                command = self.__replace_placeholders(command, self._best, output_file_name)
                 logging.info("Executing %s" % (command))
                 args = shlex.split(command)
                 
                 try:
-                    retcode = subprocess.call(args, stdout=self.stdout.opened, stderr=self.stderr.opened)
+                    retcode = self._call(args, self.input)
                 except OSError:
                     logging.error("Error executing command %s. Error was %s" % (command, OSError))
                     sys.exit(1)
@@ -136,21 +235,23 @@ class Optimiser(object):
                     if os.path.isfile(output_file_name):
                         os.unlink(output_file_name)
                 else:
-                    if self.list_only == False:
-                        # compare file sizes if the command executed successfully
-                        self._keep_smallest_file(self.input, output_file_name)
+                    # compare file sizes if the command executed successfully
+                    self._keep_smallest_file(self._best, output_file_name)
+                    if not self.reuses_output and os.path.isfile(output_file_name):
+                        os.unlink(output_file_name)
             else:
-                if self.list_only == True:
-                    is_optimised = self._list_only(self.input, output_file_name)
-                    if self.save_optimized and is_optimised:
-                        optimized_path = os.path.join(os.path.abspath(self.save_optimized), os.path.relpath(self.input, original_dir))
-                        optimized_dir = os.path.dirname(optimized_path)
-
-                        if not os.path.exists(optimized_dir):
-                            os.makedirs(optimized_dir)
+                if self.list_only == False and self._best != self.input:
+                    logging.info("Replacing %s with optimised image" % (self.input))
+                    commit.replace_file(self._best, self.input, self.preserve_mtime)
+                    self._best = self.input
 
-                        logging.info("Saving optimised image to %s" % (optimized_path))
-                        shutil.copyfile(output_file_name, optimized_path)
+                if self.list_only == True:
+                    is_optimised = self._list_only(self.input, self._best)
+                    if self.mirror is not None:
+                        if is_optimised:
+                            self.mirror.save(self._best, self.input, original_dir, self.preserve_mtime)
+                        results = is_optimised and self.array_optimised_file[-1:] or []
+                        self.mirror.record(self.input, original_dir, self.format, self.fingerprint(), results, is_optimised)
 
                 if os.path.isfile(output_file_name):
                     os.unlink(output_file_name)
@@ -170,6 +271,7 @@ class Optimiser(object):
                 bytes_saved_percent = int(100 - round((output_size / float(input_size)) * 100))
                 self.files_optimised += 1
                 self.bytes_saved += bytes_saved
+                self.output_size = output_size
 
                 if bytes_saved_percent > self.min_percent:
                     self.array_optimised_file.append({
@@ -191,15 +293,22 @@ class Optimiser(object):
             input_size = os.path.getsize(input)
             output_size = os.path.getsize(output)
 
-            # if the image was optimised (output is smaller than input), overwrite the input file with the output
-            # file.
+            # if the image was optimised (output is smaller than input), keep the output as the staged
+            # version of the file, which later commands start from.
             if (output_size > 0 and output_size < input_size):
                 try:
-                    shutil.copyfile(output, input)
-                    self.files_optimised += 1
-                    self.bytes_saved += (input_size - output_size)
-                except IOError:
-                    logging.error("Unable to copy %s to %s: %s" % (output, input, IOError))
+                    if self._best == self.input:
+                        self._best = commit.stage_path(self.input, Optimiser.output_suffix, self._staging_dir())
+                    if self.reuses_output:
+                        shutil.copyfile(output, self._best)
+                    else:
+                        commit.move_file(output, self._best, sync=False)
+                    if self.list_only == False:
+                        self.files_optimised += 1
+                        self.bytes_saved += (input_size - output_size)
+                        self.output_size = output_size
+                except (IOError, OSError):
+                    logging.error("Unable to stage %s as %s: %s" % (output, self._best, sys.exc_info()[1]))
                     sys.exit(1)
         
 
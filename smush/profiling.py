@@ -0,0 +1,86 @@
+import os, os.path, time, cProfile, pstats
+
+class Profiler(object):
+    """
+    Runs a smush session under cProfile and records the wall time of every external tool
+    invocation, then writes a .pstats file and a short text report of the hot spots.
+    """
+
+    stats_name = 'smush.pstats'
+    report_name = 'smush-report.txt'
+
+    # number of lines in each section of the report
+    top = 20
+
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.profile = cProfile.Profile()
+        self.commands = []
+
+
+    def runcall(self, callback, *args):
+        """
+        Calls callback under the profiler
+        """
+        return self.profile.runcall(callback, *args)
+
+
+    def tool_call(self, args, seconds, retcode, input):
+        """
+        Records a single invocation of an external tool; called by Metrics
+        """
+        self.commands.append((seconds, os.path.basename(args[0]), ' '.join(args), input))
+
+
+    def dump(self):
+        """
+        Writes the .pstats file and the report to the profile directory
+        """
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+
+        self.profile.dump_stats(os.path.join(self.dir, Profiler.stats_name))
+
+        report = open(os.path.join(self.dir, Profiler.report_name), 'w')
+        try:
+            report.write('smush profile written %s\n\n' % (time.strftime('%Y-%m-%d %H:%M:%S')))
+            self.__write_python(report)
+            self.__write_commands(report)
+        finally:
+            report.close()
+
+
+    def __write_python(self, report):
+        report.write('Python functions by internal time:\n')
+        stats = pstats.Stats(self.profile, stream=report)
+        stats.sort_stats('time').print_stats(Profiler.top)
+        report.write('Python functions by cumulative time:\n')
+        stats.sort_stats('cumulative').print_stats(Profiler.top)
+
+
+    def __write_commands(self, report):
+        total = sum([command[0] for command in self.commands])
+        report.write('External commands: %d invocations, %.3f seconds\n\n' % (len(self.commands), total))
+
+        tools = {}
+        files = {}
+        for (seconds, tool, command, input) in self.commands:
+            (count, tool_total, slowest) = tools.get(tool, (0, 0.0, 0.0))
+            tools[tool] = (count + 1, tool_total + seconds, max(slowest, seconds))
+            if input is not None:
+                files[input] = files.get(input, 0.0) + seconds
+
+        report.write('By tool:\n')
+        report.write('    %10s %10s %10s  %s\n' % ('calls', 'total s', 'max s', 'tool'))
+        for tool in sorted(tools, key=lambda t: tools[t][1], reverse=True):
+            (count, tool_total, slowest) = tools[tool]
+            report.write('    %10d %10.3f %10.3f  %s\n' % (count, tool_total, slowest, tool))
+
+        report.write('\nSlowest commands:\n')
+        for (seconds, tool, command, input) in sorted(self.commands, reverse=True)[:Profiler.top]:
+            report.write('    %10.3f  %s\n' % (seconds, command))
+
+        report.write('\nSlowest files (all commands):\n')
+        for input in sorted(files, key=files.get, reverse=True)[:Profiler.top]:
+            report.write('    %10.3f  %s\n' % (files[input], input))
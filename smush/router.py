@@ -0,0 +1,116 @@
+import mimetypes
+from metrics import Metrics
+
+class Router(object):
+    """
+    Decides, from its size, whether a file goes through the full set of commands for its format,
+    a single cheap command ('light'), or is skipped altogether ('skip').
+
+    Thresholds are given per format as returned by 'identify'; animated gifs use the GIF one.
+    """
+
+    actions = ('light', 'skip')
+
+    # formats with a light command set that's cheaper than the full one; jpegs of 10kB or less
+    # only get a single jpegtran pass already, so small ones can only be skipped
+    light_formats = ('PNG', 'GIF')
+
+    mime_formats = {
+        'image/png': 'PNG',
+        'image/jpeg': 'JPEG',
+        'image/gif': 'GIF',
+    }
+
+
+    def __init__(self, thresholds, action='light', metrics=None):
+        Router.check(thresholds, action)
+        self.thresholds = thresholds
+        self.action = action
+        self.metrics = metrics or Metrics()
+        self.decisions = {}
+
+
+    @staticmethod
+    def parse(spec):
+        """
+        Parses thresholds given as 'FORMAT:BYTES,...', e.g. 'PNG:1024,JPEG:2048'
+        """
+        thresholds = {}
+        for pair in spec.split(','):
+            if len(pair.strip()) == 0:
+                continue
+            (format, size) = pair.split(':')
+            thresholds[format.strip().upper()] = int(size)
+        return thresholds
+
+
+    @staticmethod
+    def check(thresholds, action):
+        """
+        Raises ValueError for an unknown action, or for a light threshold on a format without
+        light commands
+        """
+        if action not in Router.actions:
+            raise ValueError('unknown action %s' % (action))
+        if action == 'light':
+            for format in thresholds:
+                if format not in Router.light_formats:
+                    raise ValueError('%s files can only be skipped when small' % (format))
+
+
+    def threshold(self, key):
+        """
+        Returns the size in bytes below which files of the given format are considered small
+        """
+        if key == 'GIFGIF':
+            key = 'GIF'
+        return self.thresholds.get(key, 0)
+
+
+    def guess(self, file):
+        """
+        Returns the likely format of a file from its extension, without running identify
+        """
+        (type, encoding) = mimetypes.guess_type(file)
+        return Router.mime_formats.get(type)
+
+
+    def route(self, key, size):
+        """
+        Returns 'full', 'light' or 'skip' for a file of the given format and size
+        """
+        if size < self.threshold(key):
+            return self.action
+        return 'full'
+
+
+    def record(self, key, route):
+        """
+        Counts a routing decision
+        """
+        routes = self.decisions.setdefault(key, {})
+        routes[route] = routes.get(route, 0) + 1
+        self.metrics.inc('smush_router_decisions_total', format=key, route=route)
+
+
+    def describe(self, key):
+        """
+        Returns the routing applied to a format, for cache fingerprints
+        """
+        return '%s<%d' % (self.action, self.threshold(key))
+
+
+    def stats(self):
+        output = []
+        for key in sorted(self.decisions):
+            # formats without a threshold always go down the full path
+            if self.threshold(key) == 0:
+                continue
+            routes = self.decisions[key]
+            output.append('    %s: %d full, %d light, %d skipped (below %d bytes)' % (
+                    key,
+                    routes.get('full', 0),
+                    routes.get('light', 0),
+                    routes.get('skip', 0),
+                    self.threshold(key),))
+        return output
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 
-import sys, os, os.path, getopt, time, shlex, subprocess, logging, shutil
+import sys, os, os.path, getopt, time, shlex, subprocess, logging, shutil, tarfile, zipfile
 from subprocess import CalledProcessError
 from optimiser.formats.png import OptimisePNG
 from optimiser.formats.jpg import OptimiseJPG
 from optimiser.formats.gif import OptimiseGIF
 from optimiser.formats.animated_gif import OptimiseAnimatedGIF
+from optimiser.formats.webp import OptimiseWebP
 from scratch import Scratch
+from metrics import Metrics
+from mirror import Mirror
+from archive import Archive
+from router import Router
+from profiling import Profiler
+import commit
 
 __author__     = 'al, Takashi Mizohata'
 __credit__     = ['al', 'Takashi Mizohata']
@@ -16,6 +23,21 @@ __maintainer__ = 'Takashi Mizohata'
 
 class Smush():
     def __init__(self, **kwargs):
+        self.metrics = Metrics(kwargs.get('metrics_file'), kwargs.get('metrics_interval'))
+        kwargs['metrics'] = self.metrics
+        self.mirror = None
+        if kwargs.get('save_optimized'):
+            self.mirror = Mirror(kwargs.get('save_optimized'))
+        kwargs['mirror'] = self.mirror
+        self.router = None
+        if kwargs.get('small_thresholds'):
+            self.router = Router(kwargs.get('small_thresholds'), kwargs.get('small_action') or 'light', self.metrics)
+        kwargs['router'] = self.router
+        self.profiler = None
+        if kwargs.get('profile'):
+            self.profiler = Profiler(kwargs.get('profile'))
+            self.metrics.listeners.append(self.profiler)
+
         self.optimisers = {
             'PNG': OptimisePNG(**kwargs),
             'JPEG': OptimiseJPG(**kwargs),
@@ -23,6 +45,21 @@ class Smush():
             'GIFGIF': OptimiseAnimatedGIF(**kwargs)
         }
 
+        # archive members are staged copies, so they are always optimised in place
+        member_kwargs = dict(kwargs, list_only=False, mirror=None)
+        self.archive_optimisers = {
+            'PNG': OptimisePNG(**member_kwargs),
+            'JPEG': OptimiseJPG(**member_kwargs),
+            'GIF': OptimiseGIF(**member_kwargs),
+            'GIFGIF': OptimiseAnimatedGIF(**member_kwargs)
+        }
+        self.__archive_members_scanned = 0
+        self.__archive_results = []
+
+        self.webp = None
+        if kwargs.get('webp'):
+            self.webp = OptimiseWebP(**kwargs)
+
         self.__files_scanned = 0
         self.__start_time = time.time()
         self.exclude = {}
@@ -32,6 +69,9 @@ class Smush():
             self.exclude[dir] = True
         self.quiet = kwargs.get('quiet')
         self.identify_mime = kwargs.get('identify_mime')
+        self.list_only = kwargs.get('list_only')
+        self.min_percent = kwargs.get('min_percent')
+        self.preserve_mtime = kwargs.get('preserve_mtime')
 
         # setup tempfile for stdout and stderr
         self.stdout = Scratch()
@@ -45,19 +85,183 @@ class Smush():
         """
         Optimises a file
         """
+        if self.mirror is not None and self.__restore_from_mirror(file):
+            return
+
+        if Archive.is_archive(file):
+            self.__smush_archive(file)
+            return
+
+        # small files can be skipped on their extension alone, saving the call to identify
+        if self.router is not None and self.router.action == 'skip' and os.path.isfile(file):
+            guess = self.router.guess(file)
+            if guess is not None and self.router.route(guess, os.path.getsize(file)) == 'skip':
+                logging.info('%s is small, skipping' % (file))
+                self.router.record(guess, 'skip')
+                return
+
         key = self.__get_image_format(file)
 
         if key in self.optimisers:
+            route = self.__route(file, key)
+            if route == 'skip':
+                return
+
             logging.info('optimising file %s' % (file))
             self.__files_scanned += 1
-            self.optimisers[key].set_input(file)
-            self.optimisers[key].optimise(self.original_dir)
+            self.optimisers[key].set_input(file, route == 'light')
+            optimised = self.optimisers[key].optimise(self.original_dir)
+            if optimised and self.webp is not None:
+                self.__sidecar(file, self.optimisers[key].output_size)
+            self.metrics.maybe_write()
+
+
+    def __sidecar(self, file, reference_size):
+        """
+        Writes a WebP sidecar for an optimised image, next to it or, in list-only mode, in the
+        mirror
+        """
+        destination = None
+        if self.list_only == False:
+            destination = file + OptimiseWebP.sidecar_suffix
+        elif self.mirror is not None:
+            destination = self.mirror.path_for(file, self.original_dir) + OptimiseWebP.sidecar_suffix
+
+        result = self.webp.sidecar(file, reference_size, destination)
+        if self.mirror is not None and self.list_only == True:
+            self.mirror.record_sidecar(file, self.original_dir, self.webp.fingerprint(), result)
+
+
+    def __route(self, file, key):
+        """
+        Returns whether a file of a known format goes down the 'full' or 'light' path, or is
+        skipped
+        """
+        if self.router is None:
+            return 'full'
+
+        route = self.router.route(key, os.path.getsize(file))
+        self.router.record(key, route)
+        if route == 'skip':
+            logging.info('%s is small, skipping' % (file))
+        return route
+
+
+    def __smush_archive(self, file):
+        """
+        Optimises the image members of a tar or zip archive, replacing the archive (or saving
+        the new one to the mirror) if any member got smaller
+        """
+        logging.info('optimising archive %s' % (file))
+        results = []
+
+        def optimise_member(staged, name):
+            key = self.__get_image_format(staged)
+            if key not in self.archive_optimisers:
+                return
+
+            route = self.__route(staged, key)
+            if route == 'skip':
+                return
+
+            input_size = os.path.getsize(staged)
+            self.__files_scanned += 1
+            self.__archive_members_scanned += 1
+            self.archive_optimisers[key].set_input(staged, route == 'light')
+            self.archive_optimisers[key].optimise(os.path.dirname(staged))
+            self.metrics.maybe_write()
+
+            output_size = os.path.getsize(staged)
+            if output_size < input_size:
+                results.append({
+                    'name': '%s:%s' % (file, name),
+                    'input_size': input_size,
+                    'output_size': output_size,
+                    'bytes_saved': input_size - output_size,
+                    'bytes_saved_percent': int(100 - round((output_size / float(input_size)) * 100)),
+                })
+
+        # the rebuilt archive replaces the original, so it's staged next to it, unless it's only
+        # going into the mirror
+        output = None
+        if self.list_only == False:
+            output = commit.stage_path(file)
+        elif self.mirror is not None:
+            output = commit.stage_path(file, '', self.mirror.staging_dir())
+
+        try:
+            try:
+                Archive(file).rewrite(output, optimise_member)
+            except (tarfile.TarError, zipfile.BadZipfile, IOError, EOFError), e:
+                logging.warning('Cannot read archive %s, leaving it alone: %s' % (file, e))
+                return
+
+            reported = [r for r in results if r['bytes_saved_percent'] > self.min_percent]
+            self.__archive_results.extend(reported)
+            saved = len(reported) > 0
+
+            if output is not None and len(results) > 0:
+                if self.list_only == False:
+                    commit.replace_file(output, file, self.preserve_mtime)
+                elif saved:
+                    self.mirror.save(output, file, self.original_dir, self.preserve_mtime)
+
+            if self.mirror is not None and self.list_only == True:
+                self.mirror.record(file, self.original_dir, 'ARCHIVE', self.__fingerprint('ARCHIVE'), reported, saved)
+        finally:
+            if output is not None and os.path.isfile(output):
+                os.unlink(output)
+
+
+    def __fingerprint(self, key):
+        """
+        Returns the fingerprint of the commands applied to files of the given format
+        """
+        if key == 'ARCHIVE':
+            keys = sorted(self.archive_optimisers.keys())
+            return ':'.join([self.archive_optimisers[k].fingerprint() for k in keys])
+        return self.optimisers[key].fingerprint()
+
+
+    def __restore_from_mirror(self, file):
+        """
+        Skips a file that is unchanged since the last run with the same commands
+        """
+        if not os.path.isfile(file):
+            return False
+
+        entry = self.mirror.lookup(file, self.original_dir)
+        if entry is None or (entry['format'] not in self.optimisers and entry['format'] != 'ARCHIVE'):
+            return False
+
+        if entry['commands'] != self.__fingerprint(entry['format']):
+            return False
+
+        # archive members never get sidecars
+        if entry['format'] != 'ARCHIVE' and entry.get('webp') != (self.webp is not None and self.webp.fingerprint() or None):
+            return False
+
+        logging.info('%s is unchanged, skipping' % (file))
+        if entry['format'] == 'ARCHIVE':
+            self.__archive_results.extend(entry['results'])
+        else:
+            self.__files_scanned += 1
+            self.optimisers[entry['format']].restore(entry)
+            if entry.get('sidecar'):
+                self.webp.restore_sidecar(entry['sidecar'])
+        return True
 
 
     def process(self, dir, recursive):
         """
         Iterates through the input directory optimising files
         """
+        if self.profiler is not None:
+            return self.profiler.runcall(self.__process, dir, recursive)
+        return self.__process(dir, recursive)
+
+
+    def __process(self, dir, recursive):
         self.original_dir = dir
         if recursive:
             self.__walk(dir, self.__smush)
@@ -71,7 +275,7 @@ class Smush():
                     if self.identify_mime:
                         import mimetypes
                         (type,encoding) = mimetypes.guess_type(file)
-                        if type and (type[:5] != "image"):
+                        if type and (type[:5] != "image") and not Archive.is_archive(os.path.join(dir, file)):
                             continue
 
                     self.__smush(os.path.join(dir, file))
@@ -90,7 +294,7 @@ class Smush():
             if self.identify_mime:
                 import mimetypes
                 (type,encoding) = mimetypes.guess_type(file)        
-                if type and (type[:5] != "image"):
+                if type and (type[:5] != "image") and not Archive.is_archive(os.path.join(dir, file)):
                     continue
 
             nfile = os.path.join(dir, file)
@@ -107,10 +311,13 @@ class Smush():
         args = shlex.split(test_command)
 
         try:
+            started = time.time()
             retcode = subprocess.call(args, stdout=self.stdout.opened, stderr=self.stderr.opened)
+            self.metrics.tool_call(args, time.time() - started, retcode, input)
             if retcode != 0:
                 if self.quiet == False:
                     logging.warning(self.stderr.read().strip())
+                self.metrics.inc('smush_identify_failures_total')
                 return False
 
         except OSError:
@@ -120,6 +327,7 @@ class Smush():
             # most likely no file matched
             if self.quiet == False:
                 logging.warning('Cannot identify file.')
+            self.metrics.inc('smush_identify_failures_total')
             return False
 
         return self.stdout.read().strip()[:6]
@@ -139,6 +347,10 @@ class Smush():
 
             arr.extend(optimiser.array_optimised_file)
 
+        if self.__archive_members_scanned > 0:
+            output.append('    %d archive members' % (self.__archive_members_scanned))
+        arr.extend(self.__archive_results)
+
         modified = []
 
         if (len(arr) != 0):
@@ -147,8 +359,36 @@ class Smush():
                 if f['bytes_saved_percent']:
                     modified.append(f)
                     output.append('    %(bytes_saved_percent)s%% saved\t[%(input_size)s > %(output_size)s]\t%(name)s' % f)
+
+        if self.router is not None:
+            routing = self.router.stats()
+            if len(routing) > 0:
+                output.append('Small file routing:')
+                output.extend(routing)
+
+        sidecars = []
+        if self.webp is not None and self.webp.sidecars > 0:
+            output.append('WebP sidecars (%d, %d bytes saved over the optimised files):' % (
+                    self.webp.sidecars,
+                    self.webp.sidecar_bytes_saved,))
+            for f in self.webp.array_sidecar_file:
+                sidecars.append(f)
+                output.append('    %(bytes_saved_percent)s%% saved\t[%(input_size)s > %(output_size)s]\t%(name)s' % f)
         output.append('Total time taken: %.2f seconds' % (time.time() - self.__start_time))
-        return {'output': "\n".join(output), 'modified': modified}
+        return {'output': "\n".join(output), 'modified': modified, 'sidecars': sidecars}
+
+
+    def finish(self):
+        """
+        Flushes anything that has to outlive the session, e.g. the metrics file and the manifest
+        of the optimised mirror
+        """
+        if self.mirror is not None:
+            self.mirror.prune()
+            self.mirror.write()
+        self.metrics.write()
+        if self.profiler is not None:
+            self.profiler.dump()
 
 
     def __checkExclude(self, file):
@@ -160,7 +400,7 @@ class Smush():
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hrqs', ['help', 'recursive', 'quiet', 'strip-meta', 'exclude=','identify-mime', 'min-percent=', 'save-optimized='])
+        opts, args = getopt.getopt(sys.argv[1:], 'hrqs', ['help', 'recursive', 'quiet', 'strip-meta', 'exclude=','identify-mime', 'min-percent=', 'save-optimized=', 'metrics-file=', 'metrics-interval=', 'preserve-mtime', 'webp', 'webp-margin=', 'small-threshold=', 'small-action=', 'profile='])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -177,6 +417,14 @@ def main():
     min_percent = 3
     identify_mime = False
     save_optimized = None
+    metrics_file = None
+    metrics_interval = Metrics.default_interval
+    preserve_mtime = False
+    webp = False
+    webp_margin = OptimiseWebP.default_margin
+    small_thresholds = {}
+    small_action = 'light'
+    profile = None
 
     for opt, arg in opts:
         if opt in ('-h', '--help'):
@@ -196,11 +444,37 @@ def main():
             min_percent = int(arg)
         elif opt in ('--save-optimized'):
             save_optimized = arg
+        elif opt in ('--metrics-file'):
+            metrics_file = arg
+        elif opt in ('--metrics-interval'):
+            metrics_interval = int(arg)
+        elif opt in ('--preserve-mtime'):
+            preserve_mtime = True
+        elif opt in ('--webp'):
+            webp = True
+        elif opt in ('--webp-margin'):
+            webp_margin = int(arg)
+        elif opt in ('--small-threshold'):
+            try:
+                small_thresholds.update(Router.parse(arg))
+            except ValueError:
+                usage()
+                sys.exit(2)
+        elif opt in ('--small-action'):
+            small_action = arg
+        elif opt in ('--profile'):
+            profile = arg
         else:
             # unsupported option given
             usage()
             sys.exit(2)
 
+    try:
+        Router.check(small_thresholds, small_action)
+    except ValueError:
+        usage()
+        sys.exit(2)
+
     if quiet == True:
         logging.basicConfig(
             level=logging.WARNING,
@@ -212,17 +486,17 @@ def main():
             format='%(asctime)s %(levelname)s %(message)s',
             datefmt='%Y-%m-%d %H:%M:%S')
 
-    smush = Smush(strip_jpg_meta=strip_jpg_meta, exclude=exclude, list_only=list_only, quiet=quiet, identify_mime=identify_mime, min_percent=min_percent, save_optimized=save_optimized)
+    smush = Smush(strip_jpg_meta=strip_jpg_meta, exclude=exclude, list_only=list_only, quiet=quiet, identify_mime=identify_mime, min_percent=min_percent, save_optimized=save_optimized, metrics_file=metrics_file, metrics_interval=metrics_interval, preserve_mtime=preserve_mtime, webp=webp, webp_margin=webp_margin, small_thresholds=small_thresholds, small_action=small_action, profile=profile)
 
-    if save_optimized and os.path.isdir(save_optimized):
-        shutil.rmtree(save_optimized, True)
-
-    for arg in args:
-        try:
-            smush.process(arg, recursive)
-            logging.info('\nSmushing Finished')
-        except KeyboardInterrupt:
-            logging.info('\nSmushing aborted')
+    try:
+        for arg in args:
+            try:
+                smush.process(arg, recursive)
+                logging.info('\nSmushing Finished')
+            except KeyboardInterrupt:
+                logging.info('\nSmushing aborted')
+    finally:
+        smush.finish()
 
     result = smush.stats()
     if list_only and len(result['modified']) > 0:
@@ -251,9 +525,21 @@ on the web.
   --save-optimized=DIR   Directory to save optimised files
   --exclude=EXCLUDES     Comma separated value for excluding files
   --identify-mime        Fast identify image files via mimetype
+  --preserve-mtime       Keep the modification time of optimised and saved files
+  --webp                 Also write a .webp sidecar for each image when it's smaller
+  --webp-margin=INT      Minimum percent a sidecar must save over the optimised image (default is 5)
+  --small-threshold=FMT:BYTES[,FMT:BYTES]
+                         Treat PNG, JPEG or GIF files below BYTES as small, e.g. PNG:1024,GIF:1024
+  --small-action=ACTION  What to do with small files: 'light' runs a single cheap command (the
+                         default, PNG and GIF only), 'skip' leaves them alone
+  --profile=DIR          Profile the run, writing smush.pstats and smush-report.txt to DIR
+  --metrics-file=FILE    Write Prometheus textfile metrics to FILE (e.g. for node_exporter)
+  --metrics-interval=SEC Seconds between metrics file updates while running (default is 60)
+
+    .tar, .tar.gz, .tgz and .zip archives are rewritten with their image members optimised
 
   Dependencies:
-    sudo apt-get install imagemagick trimage gifsicle libjpeg-progs jpegoptim pngcrush pngnq optipng
+    sudo apt-get install imagemagick trimage gifsicle libjpeg-progs jpegoptim pngcrush pngnq optipng webp
 
   Could be builded by cxfreeze:
     cxfreeze smush.py --include-modules=encodings.ascii --target-dir build/
@@ -4,6 +4,16 @@ import unittest
 import os, os.path, sys, shutil, time, subprocess
 sys.path.insert(0, os.path.abspath('./smush'))
 from smush import Smush
+from metrics import Metrics
+import commit
+from mirror import Mirror
+from archive import Archive
+import tarfile, zipfile
+from optimiser.formats.webp import OptimiseWebP
+from router import Router
+from profiling import Profiler
+from optimiser.formats.png import OptimisePNG
+from optimiser.formats.gif import OptimiseGIF
 
 # import logging
 # project_name = 'test_smush'
@@ -94,6 +104,281 @@ class SmushTestSuite(TestSetup, unittest.TestCase):
             self.assertTrue(src_size > dest_size)
         return True
 
+class MetricsTestSuite(TestSetup, unittest.TestCase):
+    def test_write_textfile (self):
+        metrics_path = os.path.join(self.working_dir, 'smush.prom')
+        metrics = Metrics(metrics_path)
+        metrics.inc('smush_files_scanned_total', format='PNG')
+        metrics.inc('smush_files_scanned_total', format='PNG')
+        metrics.tool_call(['/usr/bin/optipng', '-o7'], 0.2, 1)
+        metrics.tool_call(['/usr/bin/optipng', '-o7'], 3.0, 0)
+        metrics.tool_call(['advpng', '-z4'], 0.02, 0)
+        metrics.write()
+
+        text = open(metrics_path).read()
+        self.assertTrue('# TYPE smush_files_scanned_total counter' in text)
+        self.assertTrue('smush_files_scanned_total{format="PNG"} 2' in text)
+        self.assertTrue('smush_tool_failures_total{tool="optipng"} 1' in text)
+        self.assertTrue('smush_tool_duration_seconds_bucket{tool="optipng",le="0.1"} 0' in text)
+        self.assertTrue('smush_tool_duration_seconds_bucket{tool="optipng",le="0.25"} 1' in text)
+        self.assertTrue('smush_tool_duration_seconds_bucket{tool="optipng",le="+Inf"} 2' in text)
+
+        # buckets are in increasing order, ending with +Inf, for each label set in turn
+        buckets = [line.split(' ')[0] for line in text.splitlines() if line.startswith('smush_tool_duration_seconds_bucket')]
+        bounds = [float(bound) for bound in Metrics.duration_buckets]
+        expected = []
+        for tool in ('advpng', 'optipng'):
+            expected.extend(['smush_tool_duration_seconds_bucket{tool="%s",le="%r"}' % (tool, bound) for bound in bounds])
+            expected.append('smush_tool_duration_seconds_bucket{tool="%s",le="+Inf"}' % (tool))
+        self.assertEqual(buckets, expected)
+        self.assertEqual([f for f in os.listdir(self.working_dir) if f.startswith('.smush.prom')], [])
+        return True
+
+    def test_defaults (self):
+        self.assertEqual(Metrics().interval, Metrics.default_interval)
+        smush = Smush(strip_jpg_meta=False, list_only=True, quiet=True, exclude=[], metrics_interval=0, webp=True)
+        self.assertEqual(smush.metrics.interval, 0)
+        self.assertEqual(smush.webp.margin, OptimiseWebP.default_margin)
+        self.assertEqual(OptimiseWebP(webp_margin=0).margin, 0)
+        return True
+
+class CommitTestSuite(TestSetup, unittest.TestCase):
+    def test_replace_file_keeps_mode_and_mtime (self):
+        target = os.path.join(self.working_dir, filename_gif)
+        os.chmod(target, 0640)
+        os.utime(target, (1000000000, 1000000000))
+        staged = commit.stage_path(target)
+        commit.clone_file(os.path.join(self.working_dir, 'png', 'Wikipedia-logo.png'), staged)
+
+        synced = []
+        fsync = os.fsync
+        def record_fsync(fd):
+            synced.append(os.path.exists(staged))
+            fsync(fd)
+        os.fsync = record_fsync
+        try:
+            commit.replace_file(staged, target, preserve_mtime=True)
+        finally:
+            os.fsync = fsync
+
+        # the data is flushed before the rename, and the directory after it
+        self.assertEqual(synced, [True, False])
+
+        self.assertFalse(os.path.exists(staged))
+        self.assertEqual(open(target, 'rb').read(), open(os.path.join(materials_dir, 'png', 'Wikipedia-logo.png'), 'rb').read())
+        self.assertEqual(os.stat(target).st_mode & 0777, 0640)
+        self.assertEqual(os.stat(target).st_mtime, 1000000000)
+        return True
+
+class MirrorTestSuite(TestSetup, unittest.TestCase):
+    def test_unchanged_and_pruned_entries (self):
+        mirror_dir = os.path.join(self.working_dir, 'mirror')
+        source = os.path.join(self.working_dir, 'png', 'Wikipedia-logo.png')
+        staged = commit.stage_path(source)
+        shutil.copyfile(source, staged)
+
+        mirror = Mirror(mirror_dir)
+        mirror.save(staged, source, self.working_dir)
+        mirror.record(source, self.working_dir, 'PNG', 'digest', [{'name': source}], True)
+        mirror.write()
+
+        mirror = Mirror(mirror_dir)
+        self.assertEqual(mirror.lookup(source, self.working_dir)['results'], [{'name': source}])
+
+        os.utime(source, (time.time() + 10, time.time() + 10))
+        self.assertEqual(mirror.lookup(source, self.working_dir), None)
+
+        # optimising again without --webp leaves no stale sidecar behind
+        sidecar = mirror.path_for(source, self.working_dir) + OptimiseWebP.sidecar_suffix
+        open(sidecar, 'wb').write('webp')
+        mirror.record(source, self.working_dir, 'PNG', 'digest', [{'name': source}], True)
+        self.assertFalse(os.path.exists(sidecar))
+        self.assertTrue(os.path.isfile(mirror.path_for(source, self.working_dir)))
+
+        os.unlink(source)
+        mirror.prune()
+        self.assertFalse(os.path.exists(os.path.join(mirror_dir, 'png')))
+        self.assertEqual(mirror.entries, {})
+        return True
+
+    def test_unchanged_archive_with_webp (self):
+        mirror_dir = os.path.join(self.working_dir, 'mirror')
+        bundle_dir = os.path.join(self.working_dir, 'bundle')
+        os.mkdir(bundle_dir)
+        bundle = tarfile.open(os.path.join(bundle_dir, 'bundle.tar'), 'w')
+        bundle.add(script_path, 'test_smush.py')
+        bundle.close()
+
+        options = dict(strip_jpg_meta=False, list_only=True, quiet=True, exclude=[], min_percent=3,
+                save_optimized=mirror_dir, webp=True)
+        smush = Smush(**options)
+        smush.process(bundle_dir, False)
+        smush.finish()
+
+        # results are only reported from the manifest if the archive isn't read again
+        mirror = Mirror(mirror_dir)
+        restored = {'name': 'bundle.tar:logo.png', 'input_size': 2, 'output_size': 1, 'bytes_saved': 1, 'bytes_saved_percent': 50}
+        mirror.entries['bundle.tar']['results'] = [restored]
+        mirror.write()
+
+        smush = Smush(**options)
+        smush.process(bundle_dir, False)
+        self.assertEqual(smush.stats()['modified'], [restored])
+        return True
+
+    def test_staged_in_mirror (self):
+        mirror = Mirror(os.path.join(self.working_dir, 'mirror'))
+        optimiser = OptimisePNG(quiet=True, list_only=True, mirror=mirror)
+        optimiser.set_input(os.path.join(self.working_dir, 'png', 'Wikipedia-logo.png'))
+        self.assertEqual(os.path.dirname(optimiser._get_output_file_name()), mirror.path)
+        self.assertTrue(os.path.isdir(mirror.path))
+        return True
+
+    def test_fingerprint_ignores_quiet (self):
+        for optimiser in (OptimisePNG, OptimiseGIF):
+            quiet = optimiser(quiet=True, min_percent=3)
+            verbose = optimiser(quiet=False, min_percent=3)
+            self.assertNotEqual(quiet.commands, verbose.commands)
+            self.assertEqual(quiet.fingerprint(), verbose.fingerprint())
+            self.assertNotEqual(quiet.fingerprint(), optimiser(quiet=True, min_percent=5).fingerprint())
+        return True
+
+class ArchiveTestSuite(TestSetup, unittest.TestCase):
+    def test_rewrite_tar (self):
+        source = os.path.join(self.working_dir, 'bundle.tar.gz')
+        output = os.path.join(self.working_dir, 'bundle-out.tar.gz')
+        bundle = tarfile.open(source, 'w:gz')
+        bundle.add(os.path.join(self.working_dir, 'png', 'Wikipedia-logo.png'), 'img/logo.png')
+        bundle.add(os.path.join(self.working_dir, 'png'), 'img/png')
+        bundle.add(script_path, 'test_smush.py')
+        bundle.close()
+
+        seen = []
+        def truncate(staged, name):
+            seen.append(name)
+            open(staged, 'wb').write('smushed')
+
+        self.assertTrue(Archive.is_archive(source))
+        Archive(source).rewrite(output, truncate)
+
+        self.assertEqual(seen, ['img/logo.png', 'img/png/Wikipedia-logo.png'])
+        bundle = tarfile.open(output)
+        self.assertEqual(bundle.extractfile('img/logo.png').read(), 'smushed')
+        self.assertEqual(bundle.extractfile('test_smush.py').read(), open(script_path).read())
+        bundle.close()
+        return True
+
+    def test_rewrite_zip (self):
+        source = os.path.join(self.working_dir, 'bundle.zip')
+        output = os.path.join(self.working_dir, 'bundle-out.zip')
+        bundle = zipfile.ZipFile(source, 'w', zipfile.ZIP_DEFLATED)
+        bundle.write(os.path.join(self.working_dir, 'png', 'Wikipedia-logo.png'), 'img/logo.png')
+        bundle.writestr('img/', '')
+        bundle.write(script_path, 'test_smush.py')
+        bundle.close()
+
+        seen = []
+        def truncate(staged, name):
+            seen.append(name)
+            open(staged, 'wb').write('smushed')
+
+        self.assertTrue(Archive.is_archive(source))
+        Archive(source).rewrite(output, truncate)
+
+        self.assertEqual(seen, ['img/logo.png'])
+        bundle = zipfile.ZipFile(output)
+        self.assertEqual(bundle.namelist(), ['img/logo.png', 'img/', 'test_smush.py'])
+        self.assertEqual(bundle.read('img/logo.png'), 'smushed')
+        self.assertEqual(bundle.getinfo('img/logo.png').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(bundle.read('test_smush.py'), open(script_path).read())
+        bundle.close()
+        return True
+
+    def test_unreadable_archives_are_skipped (self):
+        junk_dir = os.path.join(self.working_dir, 'junk')
+        os.mkdir(junk_dir)
+        for name in ('b.zip', 'b.tar.gz'):
+            open(os.path.join(junk_dir, name), 'wb').write('not an archive')
+
+        smush = Smush(strip_jpg_meta=False, list_only=False, quiet=True, exclude=[])
+        smush.process(junk_dir, False)
+
+        self.assertEqual(sorted(os.listdir(junk_dir)), ['b.tar.gz', 'b.zip'])
+        for name in ('b.zip', 'b.tar.gz'):
+            self.assertEqual(open(os.path.join(junk_dir, name), 'rb').read(), 'not an archive')
+        return True
+
+class WebPTestSuite(TestSetup, unittest.TestCase):
+    def test_sniff_format (self):
+        webp = OptimiseWebP(quiet=True)
+        self.assertEqual(webp._sniff_format(os.path.join(self.working_dir, 'png', 'Wikipedia-logo.png')), 'PNG')
+        self.assertEqual(webp._sniff_format(os.path.join(self.working_dir, 'jpeg', 'Brickwall_texture.jpg')), 'JPEG')
+        self.assertEqual(webp._sniff_format(os.path.join(self.working_dir, 'animated_gif', 'smiling.gif')), 'GIF')
+        self.assertEqual(webp._sniff_format(script_path), None)
+        return True
+
+    def test_sidecar_margin (self):
+        smush = Smush(strip_jpg_meta=False, list_only=True, quiet=True, exclude='.bzr,.git,.hg,.svn,.DS_Store', webp=True, webp_margin=10)
+        source = os.path.join(self.working_dir, 'png', 'Wikipedia-logo.png')
+        destination = source + OptimiseWebP.sidecar_suffix
+        sizes = []
+        def encode(args, input):
+            open(args[args.index('-o') + 1], 'wb').write('w' * sizes.pop(0))
+            return 0
+        smush.webp._call = encode
+
+        # 5% smaller than the optimised image isn't enough, and a stale sidecar is removed
+        open(destination, 'wb').write('stale')
+        sizes.append(950)
+        self.assertEqual(smush.webp.sidecar(source, 1000, destination), None)
+        self.assertFalse(os.path.exists(destination))
+
+        sizes.append(800)
+        result = smush.webp.sidecar(source, 1000, destination)
+        self.assertEqual(result['bytes_saved'], 200)
+        self.assertEqual(os.path.getsize(destination), 800)
+
+        stats = smush.stats()
+        self.assertEqual(stats['sidecars'], [result])
+        self.assertEqual(stats['modified'], [])
+        self.assertTrue('WebP sidecars (1, 200 bytes saved over the optimised files):' in stats['output'])
+        return True
+
+class RouterTestSuite(unittest.TestCase):
+    def test_route (self):
+        router = Router(Router.parse('png:1024, GIF:2048'), 'skip')
+        self.assertEqual(router.thresholds, {'PNG': 1024, 'GIF': 2048})
+        self.assertEqual(router.route('PNG', 1000), 'skip')
+        self.assertEqual(router.route('PNG', 1024), 'full')
+        self.assertEqual(router.route('GIFGIF', 2000), 'skip')
+        self.assertEqual(router.route('JPEG', 10), 'full')
+        self.assertEqual(router.guess('logo.gif'), 'GIF')
+        self.assertEqual(router.guess('notes.txt'), None)
+        self.assertRaises(ValueError, Router, {'JPEG': 2048}, 'light')
+
+        router.record('PNG', 'skip')
+        router.record('JPEG', 'full')
+        self.assertEqual(router.stats(), ['    PNG: 0 full, 0 light, 1 skipped (below 1024 bytes)'])
+        return True
+
+class ProfilerTestSuite(TestSetup, unittest.TestCase):
+    def test_dump (self):
+        profile_dir = os.path.join(self.working_dir, 'profile')
+        profiler = Profiler(profile_dir)
+        metrics = Metrics()
+        metrics.listeners.append(profiler)
+
+        self.assertEqual(profiler.runcall(sorted, [3, 1, 2]), [1, 2, 3])
+        metrics.tool_call(['pngcrush', 'slow.png'], 2.5, 0, 'slow.png')
+        metrics.tool_call(['optipng', 'fast.png'], 0.5, 0, 'fast.png')
+        profiler.dump()
+
+        self.assertTrue(os.path.isfile(os.path.join(profile_dir, 'smush.pstats')))
+        report = open(os.path.join(profile_dir, 'smush-report.txt')).read()
+        self.assertTrue('External commands: 2 invocations, 3.000 seconds' in report)
+        self.assertTrue(report.index('pngcrush slow.png') < report.index('optipng fast.png'))
+        return True
+
 if __name__ == '__main__':
     # logger.info('%s started at %d' % (project_name, time.time()))
     unittest.main()